@@ -4,27 +4,185 @@
 #     "pydantic-ai[mcp]",
 #     "click",
 #     "rich",
-#     "pandas",
-#     "matplotlib",
-#     "numpy",
+#     "uvloop; sys_platform != 'win32'",
 # ]
 # ///
 import asyncio
+import functools
+import hashlib
+import io
 import os
+import re
+import secrets
+import shutil
+import signal
+import stat
 import sys
 import tempfile
-import subprocess
+import threading
+import time
+import tokenize
 from pathlib import Path
 from dataclasses import dataclass
-from typing import Optional, List, Any, Tuple
+from importlib.util import find_spec
+from typing import TYPE_CHECKING, Optional, List, Any, Tuple
 import click
 from rich.console import Console
-from rich.syntax import Syntax
 from rich.panel import Panel
-from pydantic_ai import Agent
-from pydantic_ai.mcp import MCPServerStdio, MCPServerHTTP
+from rich.live import Live
+from rich.text import Text
+
+if TYPE_CHECKING:
+    from pydantic_ai import Agent
 
 console = Console()
+_INSTRUCTIONS = "You are an intelligent assistant that handles queries in three modes. You MUST respond in exactly one of these formats:\\n\\nFORMAT 1 - DIRECT_ANSWER: [Your explanation or answer here]\\nFORMAT 2 - CODE_EXECUTION: [Your Python code here]\\nFORMAT 3 - NEED_CONTEXT: [Your question for more information here]\\n\\nRULES:\\n- ALWAYS start with the mode followed by a colon and space\\n- For CODE_EXECUTION: Generate clean, executable Python code\\n- For DIRECT_ANSWER: Provide explanations, facts, or analysis\\n- For NEED_CONTEXT: Ask specific questions when you need more information\\n- For graphs/charts: Always save to file with descriptive names and timestamps\\n- Use pandas for CSV/Excel, json for JSON files, matplotlib/seaborn/plotly for graphs\\n- Always use print() to show results and include proper error handling\\n- DO NOT include markdown formatting (```python or ```) in CODE_EXECUTION responses\\n- If the task has several independent parts, separate their code with a line containing only '# ---' so they can run in parallel\\n- You have access to MCP tools for file operations and other capabilities when available"
+_DEFAULT_MODEL = "openai:gpt-4.1-mini" if os.getenv('OPENAI_API_KEY') else os.getenv('ANTHROPIC_MODEL', 'anthropic:claude-sonnet-4-0')
+_AGENT_CACHE: dict = {}
+_RUNNER_SCRIPT = '''
+import importlib, os, sys, sysconfig, threading, traceback, types
+sys.dont_write_bytecode = True
+sentinel = os.environ.pop('SMART_CLI_SENTINEL')
+preload = os.environ.pop('SMART_CLI_PRELOAD', '').split()
+channel = os.fdopen(os.dup(0), 'rb')
+report_out = os.fdopen(os.dup(1), 'w')
+report_err = os.fdopen(os.dup(2), 'w')
+devnull = os.open(os.devnull, os.O_RDONLY)
+os.dup2(devnull, 0)
+os.close(devnull)
+streams = [sys.stdin, sys.stdout, sys.stderr]
+cwd = os.getcwd()
+
+def reset_streams():
+    for stream in (sys.stdout, sys.stderr):
+        try:
+            stream.flush()
+        except Exception:
+            pass
+    for fd, stream in enumerate(streams):
+        if stream.closed:
+            streams[fd] = open(fd, 'w' if fd else 'r', buffering=1 if fd else -1, closefd=False)
+    sys.stdin, sys.stdout, sys.stderr = streams
+
+for module in preload:
+    try:
+        __import__(module)
+    except ImportError:
+        pass
+library_paths = tuple({sysconfig.get_path(name) for name in ('stdlib', 'platstdlib', 'purelib', 'platlib')} | {path for path in sys.path if 'site-packages' in path})
+loaded_modules = set(sys.modules)
+
+def reset_modules():
+    # Library modules stay loaded: C extensions such as numpy cannot be imported twice
+    for name in set(sys.modules) - loaded_modules:
+        path = getattr(sys.modules[name], '__file__', None)
+        if path and not os.path.abspath(path).startswith(library_paths):
+            del sys.modules[name]
+    importlib.invalidate_caches()
+
+print(sentinel, 'ready', file=report_out, flush=True)
+while header := channel.readline():
+    code = channel.read(int(header)).decode()
+    sys.modules['__main__'] = main_module = types.ModuleType('__main__')
+    sys.argv = ['<generated>']
+    error = None
+    try:
+        exec(compile(code, '<generated>', 'exec'), vars(main_module))
+    except BaseException as e:
+        error = e
+    for thread in threading.enumerate():
+        if thread is not threading.current_thread() and not thread.daemon:
+            thread.join()
+    reset_streams()
+    status = 0
+    if isinstance(error, SystemExit):
+        if error.code is None or isinstance(error.code, int):
+            status = error.code or 0
+        else:
+            print(error.code, file=sys.stderr)
+            status = 1
+    elif error is not None:
+        traceback.print_exception(type(error), error, error.__traceback__.tb_next)
+        status = 1
+    error = None
+    if 'matplotlib.pyplot' in sys.modules:
+        sys.modules['matplotlib.pyplot'].close('all')
+    os.chdir(cwd)
+    reset_modules()
+    sys.stderr.flush()
+    print(sentinel, file=report_err, flush=True)
+    print(sentinel, status, file=report_out, flush=True)
+'''
+_CODE_DEPENDENCIES = ('pandas', 'matplotlib', 'numpy')
+
+def _child_interpreter() -> Tuple[str, ...]:
+    uv = None if all(find_spec(module) for module in _CODE_DEPENDENCIES) else shutil.which('uv')
+    if uv:
+        return (uv, 'run', '--quiet', '--no-project', *(arg for module in _CODE_DEPENDENCIES for arg in ('--with', module)), 'python')
+    return (sys.executable,)
+
+_CHILD_CMD = (*_child_interpreter(), '-u', '-c', _RUNNER_SCRIPT)
+_CHILD_ENV = {**os.environ, 'PYTHONUNBUFFERED': '1'}
+_SAVED_RE = re.compile(r'saved (?:as|to):|graph saved', re.IGNORECASE)
+_MODE_RE = re.compile(r'^(DIRECT_ANSWER|CODE_EXECUTION|NEED_CONTEXT):\s*(.*)$', re.DOTALL)
+_MODE_PROBE_LENGTH = 32
+_FENCE_LINE_RE = re.compile(r'^\s*```\w*\s*$', re.MULTILINE)
+_SNIPPET_BREAK_RE = re.compile(r'^# ---\s*$', re.MULTILINE)
+_MAX_PARALLEL_SNIPPETS = 4
+_PUMP_CHUNK_SIZE = 64 * 1024
+_STREAM_STYLES = {
+    'DIRECT_ANSWER': ("Answer", "blue"),
+    'CODE_EXECUTION': ("Generated Code", "green"),
+    'NEED_CONTEXT': ("Context Request", "yellow"),
+}
+LOCAL_TEMPLATES = [
+    (re.compile(r"how many rows (?:are )?in (\S+\.csv)\??", re.IGNORECASE),
+     lambda m: f"import pandas as pd\nprint(len(pd.read_csv({m[1]!r})))"),
+    (re.compile(r"(?:show|preview) (?:the )?first (\d+) rows (?:of|in) (\S+\.csv)", re.IGNORECASE),
+     lambda m: f"import pandas as pd\nprint(pd.read_csv({m[2]!r}).head({int(m[1])}).to_string())"),
+    (re.compile(r"(?:print |show |generate )?(?:the )?first (\d+) fibonacci numbers", re.IGNORECASE),
+     lambda m: f"a, b = 0, 1\nfor _ in range({int(m[1])}):\n    print(a)\n    a, b = b, a + b"),
+]
+_CACHE_DIR = Path(os.getenv('XDG_CACHE_HOME', '~/.cache')).expanduser() / 'smart-cli'
+_CACHE_TTL = 24 * 60 * 60
+_MAX_MALFORMED_RETRIES = 3
+_MAX_CONTEXT_TURNS = 5
+_INPUT_THREAD_NAME = 'smart-cli-input'
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+def atomic_write(path: Path, content: str, force: bool = False) -> bool:
+    data = content.encode()
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+    if st is not None and not stat.S_ISREG(st.st_mode):
+        with open(path, 'wb') as f:
+            f.write(data)
+        return True
+    if not force and st is not None and st.st_size == len(data):
+        try:
+            if Path(path).read_bytes() == data:
+                return False
+        except OSError:
+            pass
+    target = Path(os.path.realpath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.", suffix=".tmp")
+    try:
+        with open(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmp_path, stat.S_IMODE(st.st_mode) if st else 0o666 & ~_UMASK)
+        os.replace(tmp_path, target)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return True
 
 @dataclass
 class Config:
@@ -32,92 +190,138 @@ class Config:
     save: Optional[str]
     show_code: bool
     interactive: bool
+    cache: bool
+    latency: bool
+    history_window: int
+    batch: bool = False
 
 class ResponseHandler:
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, label: str = ""):
         self.config = config
-        self.handlers = {
-            'DIRECT_ANSWER:': self._handle_direct_answer,
-            'CODE_EXECUTION:': self._handle_code_execution,
-            'NEED_CONTEXT:': self._handle_need_context,
-        }
+        self.label = label
+        self.runners = [CodeRunner(preload=config.interactive)]
+    
+    async def close(self):
+        await asyncio.gather(*(runner.close() for runner in self.runners))
     
     async def handle_response(self, response: str) -> Tuple[bool, Optional[str]]:
         response = response.strip()
         
-        if response in ['CODE_EXECUTION', 'DIRECT_ANSWER', 'NEED_CONTEXT']:
+        if response in self.HANDLERS:
             console.print(f"[red]Error: Malformed response from AI. Got '{response}' without content.[/red]")
             return False, "Please provide a complete response. Original query: {}"
         
-        for prefix, handler in self.handlers.items():
-            if response.startswith(prefix):
-                return await handler(response, prefix)
+        match = _MODE_RE.match(response)
+        if match:
+            return await self.HANDLERS[match.group(1)](self, match.group(2))
         
         return await self._handle_fallback(response)
     
-    async def _handle_direct_answer(self, response: str, prefix: str) -> Tuple[bool, Optional[str]]:
-        answer = response.replace(prefix, '', 1).strip()
+    async def _handle_direct_answer(self, body: str) -> Tuple[bool, Optional[str]]:
+        answer = body.strip()
         if not answer:
             console.print("[red]Error: Empty DIRECT_ANSWER response[/red]")
             return False, None
-        console.print(Panel(answer, title="Answer", border_style="blue"))
-        self._save_content(answer, "Answer")
+        save_notice = await self._save_content(answer, "Answer")
+        with console:
+            console.print(Panel(answer, title=self._title("Answer"), border_style="blue"))
+            if save_notice:
+                console.print(save_notice)
         return True, None
     
-    async def _handle_code_execution(self, response: str, prefix: str) -> Tuple[bool, Optional[str]]:
-        code = self._clean_markdown(response.replace(prefix, '', 1))
+    async def _handle_code_execution(self, body: str) -> Tuple[bool, Optional[str]]:
+        code = self._clean_markdown(body)
         if not code:
             console.print("[red]Error: Empty CODE_EXECUTION response[/red]")
             return False, None
-        self._display_code(code)
-        self._save_content(code, "Code")
+        save_notice = await self._save_content(code, "Code")
+        with console:
+            self._display_code(code)
+            if save_notice:
+                console.print(save_notice)
+            if self.config.execute:
+                console.print("[yellow]Executing code...[/yellow]")
         if self.config.execute:
-            console.print("[yellow]Executing code...[/yellow]")
-            await execute_code(code)
+            await execute_snippets(split_snippets(code), self.runners, self.label)
         return True, None
     
-    async def _handle_need_context(self, response: str, prefix: str) -> Tuple[bool, Optional[str]]:
-        context_request = response.replace(prefix, '', 1).strip()
+    async def _handle_need_context(self, body: str) -> Tuple[bool, Optional[str]]:
+        context_request = body.strip()
         if not context_request:
             console.print("[red]Error: Empty NEED_CONTEXT response[/red]")
             return False, None
-        console.print(Panel(context_request, title="Context Request", border_style="yellow"))
-        self._save_content(context_request, "Context request")
+        save_notice = await self._save_content(context_request, "Context request")
+        with console:
+            console.print(Panel(context_request, title=self._title("Context Request"), border_style="yellow"))
+            if save_notice:
+                console.print(save_notice)
+        if self.config.batch:
+            raise RuntimeError(f"Model asked for more context, which batch mode cannot provide: {context_request}")
         console.print("\\n[cyan]Please provide the requested information:[/cyan]")
-        user_context = input("> ").strip()
+        user_context = (await _ainput("> ")).strip()
         if not user_context:
             console.print("[red]No context provided.[/red]")
             return False, None
         console.print(f"[blue]Continuing with context: {user_context}[/blue]")
-        return False, f"Context provided: {user_context}. Original query: {{}}"
+        return False, user_context
     
     async def _handle_fallback(self, response: str) -> Tuple[bool, Optional[str]]:
-        self._display_code(response)
-        self._save_content(response, "Content")
+        save_notice = await self._save_content(response, "Content")
+        with console:
+            self._display_code(response)
+            if save_notice:
+                console.print(save_notice)
+            if self.config.execute:
+                console.print("[yellow]Executing...[/yellow]")
         if self.config.execute:
-            console.print("[yellow]Executing...[/yellow]")
-            await execute_code(response)
+            await execute_snippets(split_snippets(response), self.runners, self.label)
         return True, None
     
     def _clean_markdown(self, text: str) -> str:
-        text = text.strip()
-        for marker in ['```python', '```']:
-            if text.startswith(marker):
-                text = text.replace(marker, '', 1)
-        return text.rsplit('```', 1)[0].strip() if text.endswith('```') else text
+        return text.strip().removeprefix('```python').removeprefix('```').removesuffix('```').strip()
     
-    def _save_content(self, content: str, content_type: str):
-        if self.config.save:
-            Path(self.config.save).write_text(content)
-            console.print(f"[green]{content_type} saved to {self.config.save}[/green]")
+    async def _save_content(self, content: str, content_type: str) -> Optional[str]:
+        if not self.config.save:
+            return None
+        save_path = Path(self.config.save)
+        if await asyncio.to_thread(atomic_write, save_path, content):
+            return f"[green]{content_type} saved to {save_path.resolve()}[/green]"
+        return f"[green]{content_type} unchanged in {save_path.resolve()}[/green]"
     
     def _display_code(self, code: str):
         if self.config.show_code:
-            console.print(Panel(Syntax(code, "python", theme="monokai", line_numbers=True), title="Generated Code", border_style="green"))
+            console.print(_code_panel(code, console.width, self._title("Generated Code")))
+    
+    def _title(self, title: str) -> str:
+        return f"{title} {self.label}" if self.label else title
+    
+    HANDLERS = {
+        'DIRECT_ANSWER': _handle_direct_answer,
+        'CODE_EXECUTION': _handle_code_execution,
+        'NEED_CONTEXT': _handle_need_context,
+    }
+
+@functools.cache
+def _code_style():
+    from pygments.lexers import PythonLexer
+    from rich.syntax import Syntax
+    return PythonLexer(), Syntax.get_theme("monokai")
 
-def get_agent(model: str = None, mcp_servers: list = None) -> Agent:
-    model = model or ("openai:gpt-4.1-mini" if os.getenv('OPENAI_API_KEY') else 
-                      os.getenv('ANTHROPIC_MODEL', 'anthropic:claude-sonnet-4-0'))
+@functools.lru_cache(maxsize=32)
+def _code_panel(code: str, width: int, title: str = "Generated Code"):
+    from rich.segment import Segments
+    from rich.syntax import Syntax
+    lexer, theme = _code_style()
+    panel = Panel(Syntax(code, lexer, theme=theme, line_numbers=True), title=title, border_style="green")
+    return Segments(console.render(panel, console.options.update_width(width)))
+
+def resolve_model(model: str = None) -> str:
+    return model or _DEFAULT_MODEL
+
+def get_agent(model: str = None, mcp_servers: list = None) -> "Agent":
+    from pydantic_ai import Agent
+    from pydantic_ai.mcp import MCPServerStdio
+    model = resolve_model(model)
     
     if mcp_servers is None:
         mcp_servers = []
@@ -126,10 +330,17 @@ def get_agent(model: str = None, mcp_servers: list = None) -> Agent:
         except:
             pass
     
-    return Agent(model, mcp_servers=mcp_servers, end_strategy='loop',
-        instructions="You are an intelligent assistant that handles queries in three modes. You MUST respond in exactly one of these formats:\\n\\nFORMAT 1 - DIRECT_ANSWER: [Your explanation or answer here]\\nFORMAT 2 - CODE_EXECUTION: [Your Python code here]\\nFORMAT 3 - NEED_CONTEXT: [Your question for more information here]\\n\\nRULES:\\n- ALWAYS start with the mode followed by a colon and space\\n- For CODE_EXECUTION: Generate clean, executable Python code\\n- For DIRECT_ANSWER: Provide explanations, facts, or analysis\\n- For NEED_CONTEXT: Ask specific questions when you need more information\\n- For graphs/charts: Always save to file with descriptive names and timestamps\\n- Use pandas for CSV/Excel, json for JSON files, matplotlib/seaborn/plotly for graphs\\n- Always use print() to show results and include proper error handling\\n- DO NOT include markdown formatting (```python or ```) in CODE_EXECUTION responses\\n- You have access to MCP tools for file operations and other capabilities when available")
+    key = (model, tuple(map(repr, mcp_servers)))
+    if key in _AGENT_CACHE:
+        return _AGENT_CACHE[key]
+    _AGENT_CACHE[key] = agent = Agent(model, mcp_servers=mcp_servers, end_strategy='loop',
+        instructions=_INSTRUCTIONS)
+    return agent
 
 def parse_mcp_servers(server_configs: List[str]) -> List[Any]:
+    if not server_configs:
+        return []
+    from pydantic_ai.mcp import MCPServerStdio, MCPServerHTTP
     mcp_servers = []
     for config in server_configs:
         try:
@@ -146,17 +357,38 @@ def show_config_info(model: str, mcp_servers: List[Any], interactive: bool):
     if model:
         console.print(f"[cyan]Using model: {model}[/cyan]")
     elif os.getenv('OPENAI_API_KEY'):
-        console.print(f"[cyan]Using model: openai:gpt-4.1-mini (OpenAI API key detected)[/cyan]")
+        console.print(f"[cyan]Using model: {_DEFAULT_MODEL} (OpenAI API key detected)[/cyan]")
     elif os.getenv('ANTHROPIC_MODEL'):
-        console.print(f"[cyan]Using model: {os.getenv('ANTHROPIC_MODEL')}[/cyan]")
+        console.print(f"[cyan]Using model: {_DEFAULT_MODEL}[/cyan]")
     if mcp_servers:
         console.print(f"[cyan]MCP servers configured: {len(mcp_servers)}[/cyan]")
     if interactive:
         console.print(f"[green]Interactive mode enabled. Type 'exit' or 'quit' to stop.[/green]")
 
-def get_user_input(prompt: str) -> Optional[str]:
+async def _ainput(prompt: str) -> str:
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    
+    def resolve(set_outcome, value):
+        if not future.done():
+            set_outcome(value)
+    
+    def read():
+        try:
+            outcome = (future.set_result, input(prompt))
+        except BaseException as e:
+            outcome = (future.set_exception, e)
+        try:
+            loop.call_soon_threadsafe(resolve, *outcome)
+        except RuntimeError:
+            pass
+    
+    threading.Thread(target=read, name=_INPUT_THREAD_NAME, daemon=True).start()
+    return await future
+
+async def get_user_input(prompt: str) -> Optional[str]:
     console.print(f"\\n[cyan]{prompt}[/cyan]")
-    user_input = input("> ").strip()
+    user_input = (await _ainput("> ")).strip()
     if user_input.lower() in ['exit', 'quit', 'q']:
         console.print("[green]Goodbye![/green]")
         return None
@@ -165,69 +397,278 @@ def get_user_input(prompt: str) -> Optional[str]:
         return ""
     return user_input
 
-async def execute_code(code: str):
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as f:
-        f.write(code)
-        temp_file = f.name
+async def _pump(stream: asyncio.StreamReader, emit, sentinel: str) -> Optional[str]:
+    pending = b""
+    while chunk := await stream.read(_PUMP_CHUNK_SIZE):
+        *lines, pending = (pending + chunk).split(b"\n")
+        for raw in lines:
+            line = raw.decode(errors='replace').rstrip()
+            head, found, tail = line.partition(sentinel)
+            if found:
+                if head:
+                    emit(head)
+                return tail.strip()
+            emit(line)
+    if pending:
+        emit(pending.decode(errors='replace').rstrip())
+    return None
+
+class CodeRunner:
+    def __init__(self, preload: bool = True):
+        self.preload = preload
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self.sentinel = ""
+        self.lock = asyncio.Lock()
+    
+    async def run(self, code: str, emit_stdout, emit_stderr, timeout: float) -> int:
+        async with self.lock:
+            if self.proc is None or self.proc.returncode is not None:
+                await self._start()
+            data = code.encode()
+            self.proc.stdin.write(b"%d\n" % len(data) + data)
+            pumps = [asyncio.ensure_future(_pump(self.proc.stdout, emit_stdout, self.sentinel)),
+                     asyncio.ensure_future(_pump(self.proc.stderr, emit_stderr, self.sentinel))]
+            try:
+                await self.proc.stdin.drain()
+                status, _ = await asyncio.wait_for(asyncio.gather(*pumps), timeout=timeout)
+            except BaseException:
+                for pump in pumps:
+                    pump.cancel()
+                await self._kill()
+                raise
+            if status is None:
+                return await self.proc.wait()
+            if not status.lstrip('-').isdigit():
+                await self._kill()
+                raise RuntimeError(f"Code worker sent an invalid status: {status!r}")
+            return int(status)
+    
+    async def close(self):
+        if self.proc is None or self.proc.returncode is not None:
+            self.proc = None
+            return
+        self.proc.stdin.close()
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            await self._kill()
+        self.proc = None
+    
+    async def _start(self):
+        self.sentinel = secrets.token_hex(16)
+        preload = _CODE_DEPENDENCIES if self.preload else ()
+        env = {**_CHILD_ENV, 'SMART_CLI_SENTINEL': self.sentinel, 'SMART_CLI_PRELOAD': ' '.join(preload)}
+        self.proc = await asyncio.create_subprocess_exec(*_CHILD_CMD, env=env, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, start_new_session=True)
+        if await _pump(self.proc.stdout, lambda line: None, self.sentinel) != 'ready':
+            error = (await self.proc.stderr.read()).decode(errors='replace').strip()
+            await self._kill()
+            raise RuntimeError(f"Code worker failed to start: {error or 'no output'}")
+    
+    async def _kill(self):
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            else:
+                self.proc.kill()
+        except ProcessLookupError:
+            pass
+        await self.proc.wait()
+        self.proc = None
+
+def _compiles(code: str) -> bool:
+    try:
+        compile(code, '<generated>', 'exec')
+    except (SyntaxError, ValueError):
+        return False
+    return True
+
+def split_snippets(code: str) -> List[str]:
+    if not _compiles(code):
+        unfenced = _FENCE_LINE_RE.sub('', code)
+        if not _compiles(unfenced):
+            return [code]
+        code = unfenced
+    breaks = [token.start[0] for token in tokenize.generate_tokens(io.StringIO(code).readline)
+              if token.type == tokenize.COMMENT and token.start[1] == 0 and _SNIPPET_BREAK_RE.fullmatch(token.string)]
+    if not breaks:
+        return [code]
+    lines = code.splitlines(keepends=True)
+    bounds = zip([0, *breaks], [line - 1 for line in breaks] + [len(lines)])
+    snippets = [snippet for snippet in (''.join(lines[start:end]) for start, end in bounds) if snippet.strip()]
+    if len(snippets) < 2 or not all(map(_compiles, snippets)):
+        return [code]
+    return [snippet.strip() for snippet in snippets]
+
+async def execute_snippets(snippets: List[str], runners: List[CodeRunner], label: str = ""):
+    if len(snippets) == 1:
+        return await execute_code(snippets[0], runners[0], label)
+    while len(runners) < min(len(snippets), _MAX_PARALLEL_SNIPPETS):
+        runners.append(CodeRunner(preload=runners[0].preload))
+    await asyncio.gather(*(execute_code(snippet, runners[i % len(runners)], f"{label} {i + 1}/{len(snippets)}".lstrip())
+                           for i, snippet in enumerate(snippets)))
+
+async def execute_code(code: str, runner: CodeRunner, label: str = ""):
+    prefix = f"{label} " if label else ""
+    console.print(f"[green]--- Output {prefix}---[/green]")
+    saved = False
+    
+    def emit_stdout(line: str):
+        nonlocal saved
+        console.print(prefix + line)
+        if not saved and _SAVED_RE.search(line):
+            saved = True
     
     try:
-        result = subprocess.run([sys.executable, temp_file], capture_output=True, text=True, timeout=30)
-        console.print("[green]--- Output ---[/green]")
-        if result.stdout:
-            console.print(result.stdout)
-            if any(phrase in result.stdout.lower() for phrase in ["saved as:", "saved to:", "graph saved"]):
-                console.print("[cyan]💾 File saved successfully![/cyan]")
-        if result.stderr:
-            console.print(f"[red]Errors:[/red]\\n{result.stderr}")
-        if result.returncode != 0:
-            console.print(f"[red]Process exited with code {result.returncode}[/red]")
-    except subprocess.TimeoutExpired:
-        console.print("[red]Code execution timed out (30s limit)[/red]")
+        returncode = await runner.run(code, emit_stdout, lambda line: console.print(prefix + line, style="red"), timeout=30)
+    except asyncio.TimeoutError:
+        console.print(f"[red]{prefix}Code execution timed out (30s limit)[/red]")
+        return
     except Exception as e:
-        console.print(f"[red]Execution error: {e}[/red]")
-    finally:
-        os.unlink(temp_file)
+        console.print(f"[red]{prefix}Execution error: {e}[/red]")
+        return
+    if saved:
+        console.print(f"[cyan]{prefix}💾 File saved successfully![/cyan]")
+    if returncode != 0:
+        console.print(f"[red]{prefix}Process exited with code {returncode}[/red]")
+
+def model_settings(model: str, latency: bool) -> Optional[dict]:
+    if latency and model.startswith('bedrock:'):
+        return {'bedrock_performance_configuration': {'latency': 'optimized'}}
+    return None
+
+async def stream_response(agent: "Agent", query: str, history: list, settings: Optional[dict] = None, live: bool = True) -> Tuple[str, list]:
+    if not live:
+        result = await agent.run(query, message_history=history or None, model_settings=settings)
+        return result.output, result.new_messages()
+    text = Text()
+    panel = Panel(text, title="Response", border_style="dim")
+    mode_decided = False
+    with Live(panel, console=console, transient=True, refresh_per_second=8):
+        async with agent.run_stream(query, message_history=history or None, model_settings=settings) as result:
+            async for chunk in result.stream_text(delta=True):
+                text.append(chunk)
+                if not mode_decided and len(text) >= _MODE_PROBE_LENGTH:
+                    mode_decided = True
+                    match = _MODE_RE.match(text.plain.lstrip())
+                    if match:
+                        panel.title, panel.border_style = _STREAM_STYLES[match.group(1)]
+    return text.plain, result.new_messages()
+
+def exchange_messages(query: str, response: str) -> list:
+    from pydantic_ai.messages import ModelRequest, ModelResponse, TextPart, UserPromptPart
+    return [ModelRequest(parts=[UserPromptPart(content=query)]), ModelResponse(parts=[TextPart(content=response)])]
+
+def local_response(query: str) -> Optional[str]:
+    for pattern, generate in LOCAL_TEMPLATES:
+        match = pattern.fullmatch(query.strip())
+        if match:
+            return f"CODE_EXECUTION: {generate(match)}"
+    return None
+
+def _cache_path(model: str, query: str) -> Path:
+    key = hashlib.sha256(f"{model}\0{_INSTRUCTIONS}\0{query}".encode()).hexdigest()
+    return _CACHE_DIR / f"{key}.txt"
+
+def load_cached_response(model: str, query: str) -> Optional[str]:
+    path = _cache_path(model, query)
+    try:
+        if time.time() - path.stat().st_mtime < _CACHE_TTL:
+            return path.read_text()
+    except OSError:
+        pass
+    return None
+
+def store_cached_response(model: str, query: str, response: str):
+    match = _MODE_RE.match(response)
+    if not match or match.group(1) == 'NEED_CONTEXT':
+        return
+    try:
+        _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        atomic_write(_cache_path(model, query), response, force=True)
+    except OSError as e:
+        console.print(f"[yellow]Warning: Failed to cache response: {e}[/yellow]")
+
+async def answer_query(agent: "Agent", handler: ResponseHandler, query: str, model: str, history: Optional[list] = None, live: bool = True) -> bool:
+    current_query = query
+    history = [] if history is None else history
+    settings = model_settings(model, handler.config.latency)
+    malformed_retries = context_turns = 0
+    while True:
+        use_cache = handler.config.cache and not history
+        response = local_response(current_query) if not context_turns and not malformed_retries else None
+        status = "[cyan]Handled locally[/cyan]"
+        if response is None and use_cache:
+            response = load_cached_response(model, current_query)
+            status = "[cyan]Using cached response[/cyan]"
+        with console:
+            console.print(f"[blue]{handler._title('Query')}:[/blue] {current_query}")
+            console.print(status if response is not None else "[yellow]Processing...[/yellow]")
+        
+        if response is None:
+            output, new_messages = await stream_response(agent, current_query, history, settings, live)
+            response = handler._clean_markdown(output)
+            if use_cache:
+                store_cached_response(model, current_query, response)
+        else:
+            new_messages = exchange_messages(current_query, response)
+        
+        task_completed, next_query = await handler.handle_response(response)
+        
+        if not next_query:
+            history += new_messages
+            return task_completed
+        if _MODE_RE.match(response):
+            context_turns += 1
+            if context_turns > _MAX_CONTEXT_TURNS:
+                raise RuntimeError(f"Gave up after {_MAX_CONTEXT_TURNS} context requests")
+            history += new_messages
+            current_query = next_query
+        else:
+            malformed_retries += 1
+            if malformed_retries > _MAX_MALFORMED_RETRIES:
+                raise RuntimeError(f"Model returned malformed responses {malformed_retries} times in a row")
+            await asyncio.sleep(min(8, 2 ** malformed_retries))
+            current_query = next_query.format(query)
+
+def window_turns(turns: List[list], window: int) -> List[list]:
+    if len(turns) <= window + 1:
+        return turns
+    return turns[:1] + turns[len(turns) - window:]
 
 async def process_query(query_text: str, config: Config, model: str = None, mcp_servers: list = None):
+    model = resolve_model(model)
     agent = get_agent(model, mcp_servers)
     handler = ResponseHandler(config)
+    turns = []
     current_query = query_text
+    # run_stream ends at the first text part, so tool calls after a lead-in sentence would never run
+    live = mcp_servers is not None and not mcp_servers
     first_run = True
     
     try:
         async with agent.run_mcp_servers():
             while True:
                 if config.interactive and not first_run:
-                    current_query = get_user_input("Enter your next query (or 'exit'/'quit' to stop):")
+                    current_query = await get_user_input("Enter your next query (or 'exit'/'quit' to stop):")
                     if current_query is None:
                         break
                     if current_query == "":
                         continue
                 
                 if config.interactive and first_run and not current_query:
-                    current_query = get_user_input("Enter your query:")
+                    current_query = await get_user_input("Enter your query:")
                     if current_query is None:
                         break
                     if current_query == "":
                         continue
                 
                 first_run = False
-                console.print(f"[blue]Query:[/blue] {current_query}")
-                console.print("[yellow]Processing...[/yellow]")
-                
-                result = await agent.run(current_query)
-                response = handler._clean_markdown(result.output)
-                
-                task_completed, next_query = await handler.handle_response(response)
-                
-                if next_query:
-                    current_query = next_query.format(current_query)
-                    continue
-                
-                if not task_completed and not config.interactive:
-                    break
+                history = [message for turn in window_turns(turns, config.history_window) for message in turn]
+                start = len(history)
+                await answer_query(agent, handler, current_query, model, history, live)
+                turns.append(history[start:])
                 
-                if not config.interactive and task_completed:
+                if not config.interactive:
                     break
     
     except KeyboardInterrupt:
@@ -236,6 +677,38 @@ async def process_query(query_text: str, config: Config, model: str = None, mcp_
         console.print(f"[red]Error: {e}[/red]")
         if not config.interactive:
             sys.exit(1)
+    finally:
+        await handler.close()
+
+async def process_batch(queries: List[str], config: Config, model: str = None, mcp_servers: list = None, concurrency: int = 4):
+    model = resolve_model(model)
+    agent = get_agent(model, mcp_servers)
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def run_one(number: int, query: str) -> bool:
+        async with semaphore:
+            handler = ResponseHandler(config, f"#{number}")
+            try:
+                return await answer_query(agent, handler, query, model, live=False)
+            finally:
+                await handler.close()
+    
+    try:
+        async with agent.run_mcp_servers():
+            results = await asyncio.gather(*(run_one(number, query) for number, query in enumerate(queries, 1)), return_exceptions=True)
+    except KeyboardInterrupt:
+        console.print("\\n[yellow]Operation cancelled by user[/yellow]")
+        return
+    except Exception as e:
+        console.print(f"[red]Error: {e}[/red]")
+        sys.exit(1)
+    
+    failed = [(number, query, result) for number, (query, result) in enumerate(zip(queries, results), 1) if isinstance(result, Exception)]
+    for number, query, error in failed:
+        console.print(f"[red]Error in query #{number} '{query}': {error}[/red]")
+    console.print(f"[cyan]Batch complete: {len(queries) - len(failed)}/{len(queries)} queries succeeded[/cyan]")
+    if failed:
+        sys.exit(1)
 
 @click.command()
 @click.argument('query', nargs=-1, required=False)
@@ -245,20 +718,53 @@ async def process_query(query_text: str, config: Config, model: str = None, mcp_
 @click.option('--model', '-m', help='AI model to use (e.g., anthropic:claude-sonnet-4-0, openai:gpt-4.1-mini)')
 @click.option('--mcp-server', multiple=True, help='MCP server to add (format: type:config)')
 @click.option('--interactive', '-i', is_flag=True, help='Interactive mode - continue conversation after each response')
-def main(query, execute, save, show_code, model, mcp_server, interactive):
+@click.option('--batch-file', type=click.Path(exists=True, dir_okay=False), help='Run each non-empty line of a file as a separate query')
+@click.option('--cache/--no-cache', default=True, help='Reuse cached responses for repeated queries for 24h (off when MCP servers are configured)')
+@click.option('--latency/--no-latency', default=True, help='Request latency-optimized inference where the provider supports it (Bedrock)')
+@click.option('--history-window', type=click.IntRange(min=0), default=6, help='Number of recent interactive turns sent as context, besides the first')
+@click.option('--concurrency', '-c', type=click.IntRange(min=1), default=4, help='Maximum concurrent queries in batch mode')
+def main(query, execute, save, show_code, model, mcp_server, interactive, batch_file, cache, latency, history_window, concurrency):
     """Smart CLI: Generate and execute Python code from natural language queries with MCP support."""
-    interactive = interactive or not query
     query_text = ' '.join(query) if query else ""
     
     if query and not query_text.strip():
         console.print("[red]Error: Please provide a query[/red]")
         sys.exit(1)
     
+    queries = []
+    if batch_file:
+        if query or interactive:
+            console.print("[red]Error: --batch-file cannot be combined with a query or --interactive[/red]")
+            sys.exit(1)
+        queries = [line.strip() for line in Path(batch_file).read_text().splitlines() if line.strip()]
+        if not queries:
+            console.print(f"[red]Error: No queries found in {batch_file}[/red]")
+            sys.exit(1)
+    else:
+        interactive = interactive or not query
+    
     mcp_servers = parse_mcp_servers(mcp_server)
     show_config_info(model, mcp_servers, interactive)
     
-    config = Config(execute=execute, save=save, show_code=show_code, interactive=interactive)
-    asyncio.run(process_query(query_text, config, model, mcp_servers))
+    config = Config(execute=execute, save=save, show_code=show_code, interactive=interactive, cache=cache and not mcp_servers, latency=latency, history_window=history_window, batch=bool(queries))
+    if queries:
+        entrypoint = process_batch(queries, config, model, mcp_servers, concurrency)
+    else:
+        entrypoint = process_query(query_text, config, model, mcp_servers)
+    try:
+        import uvloop
+        loop_factory = uvloop.new_event_loop
+    except ImportError:
+        loop_factory = None
+    try:
+        asyncio.run(entrypoint, loop_factory=loop_factory)
+    except KeyboardInterrupt:
+        console.print("\\n[yellow]Operation cancelled by user[/yellow]")
+        if any(thread.name == _INPUT_THREAD_NAME for thread in threading.enumerate()):
+            # A reader still blocked in input() holds the stdin lock, which aborts interpreter shutdown
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file